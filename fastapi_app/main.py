@@ -8,7 +8,7 @@ import httpx
 import uvicorn
 from fastapi import FastAPI, Response
 from opentelemetry.propagate import inject
-from utils import setting_otlp
+from utils import OtelAccessFormatter, setting_otlp
 
 APP_NAME = os.environ.get("APP_NAME", "app")
 EXPOSE_PORT = int(os.environ.get("EXPOSE_PORT", "8000"))
@@ -99,6 +99,7 @@ async def chain(response: Response):
 if __name__ == "__main__":
     # update uvicorn access logger format
     log_config = uvicorn.config.LOGGING_CONFIG
+    log_config["formatters"]["access"]["()"] = OtelAccessFormatter
     log_config["formatters"]["access"]["fmt"] = (
         "%(asctime)s %(levelname)s [%(name)s] [%(filename)s:%(lineno)d] [trace_id=%(otelTraceID)s span_id=%(otelSpanID)s resource.service.name=%(otelServiceName)s] - %(message)s"
     )
@@ -0,0 +1,230 @@
+import grpc
+import pytest
+from opentelemetry.metrics import NoOpMeterProvider
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import InMemoryMetricReader
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+    InMemorySpanExporter,
+)
+from opentelemetry.trace import NoOpTracerProvider
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Host, Mount, Route, WebSocketRoute
+from starlette.testclient import TestClient
+
+from utils import (
+    OtelMiddleware,
+    compile_routes_regex,
+    otlp_compression,
+    traces_sampler,
+)
+
+
+async def endpoint(request):
+    return PlainTextResponse("ok")
+
+
+def make_app(routes):
+    app = Starlette(routes=routes)
+    middleware = OtelMiddleware(
+        app,
+        app_name="test",
+        meter_provider=NoOpMeterProvider(),
+        trace_provider=NoOpTracerProvider(),
+    )
+    return app, middleware
+
+
+def get_path(middleware, app, method, path, root_path=""):
+    return middleware.get_path(
+        {
+            "type": "http",
+            "app": app,
+            "method": method,
+            "path": path,
+            "root_path": root_path,
+            "headers": [],
+        }
+    )
+
+
+class Telemetry:
+    """Application wrapped by `OtelMiddleware` recording into in-memory exporters."""
+
+    def __init__(self, routes):
+        self.app = Starlette(routes=routes)
+        self.metric_reader = InMemoryMetricReader()
+        self.span_exporter = InMemorySpanExporter()
+        tracer_provider = TracerProvider()
+        tracer_provider.add_span_processor(SimpleSpanProcessor(self.span_exporter))
+        self.app.add_middleware(
+            OtelMiddleware,
+            app_name="test",
+            meter_provider=MeterProvider(metric_readers=[self.metric_reader]),
+            trace_provider=tracer_provider,
+        )
+
+    def points(self, name):
+        """Data points of a metric, by their attributes."""
+        metrics_data = self.metric_reader.get_metrics_data()
+        points = {}
+        for resource_metrics in metrics_data.resource_metrics if metrics_data else []:
+            for scope_metrics in resource_metrics.scope_metrics:
+                for metric in scope_metrics.metrics:
+                    if metric.name == name:
+                        for point in metric.data.data_points:
+                            points[tuple(sorted(point.attributes.items()))] = point
+        return points
+
+
+class AppError(Exception):
+    pass
+
+
+async def teapot(request):
+    return PlainTextResponse("teapot", status_code=418)
+
+
+async def failing(request):
+    raise AppError("boom")
+
+
+async def websocket_endpoint(websocket):
+    await websocket.accept()
+    await websocket.send_text("ok")
+    await websocket.close()
+
+
+def test_middleware_records_status_code_sent_by_application():
+    telemetry = Telemetry([Route("/items/{item_id}", teapot)])
+
+    response = TestClient(telemetry.app).get("/items/1")
+
+    assert response.status_code == 418
+    (span,) = telemetry.span_exporter.get_finished_spans()
+    assert span.name == "GET /items/{item_id}"
+    attributes = (("app_name", "test"), ("method", "GET"), ("path", "/items/{item_id}"))
+    assert telemetry.points("fastapi_requests_total")[attributes].value == 1
+    responses = telemetry.points("fastapi_responses_total")
+    assert list(responses) == [tuple(sorted(attributes + (("status_code", 418),)))]
+    assert telemetry.points("fastapi_requests_duration_seconds")[attributes].count == 1
+    assert telemetry.points("fastapi_exceptions_total") == {}
+
+
+def test_middleware_ignores_unhandled_paths_and_other_scopes():
+    telemetry = Telemetry(
+        [Route("/", endpoint), WebSocketRoute("/ws", websocket_endpoint)]
+    )
+    client = TestClient(telemetry.app)
+
+    assert client.get("/unknown").status_code == 404
+    with client.websocket_connect("/ws") as websocket:
+        assert websocket.receive_text() == "ok"
+
+    assert telemetry.span_exporter.get_finished_spans() == ()
+    assert telemetry.points("fastapi_requests_total") == {}
+    assert telemetry.points("fastapi_responses_total") == {}
+
+
+def test_middleware_records_exception_and_reraises_it_unchanged():
+    telemetry = Telemetry([Route("/fail", failing)])
+
+    with pytest.raises(AppError) as exc_info:
+        TestClient(telemetry.app).get("/fail")
+    assert str(exc_info.value) == "boom"
+    assert not exc_info.value.__suppress_context__
+    assert exc_info.traceback[-1].name == "failing"
+
+    attributes = (("app_name", "test"), ("method", "GET"), ("path", "/fail"))
+    exceptions = telemetry.points("fastapi_exceptions_total")
+    assert list(exceptions) == [
+        tuple(sorted(attributes + (("exception_type", "AppError"),)))
+    ]
+    responses = telemetry.points("fastapi_responses_total")
+    assert list(responses) == [tuple(sorted(attributes + (("status_code", 500),)))]
+    # Failed requests are counted but not timed
+    assert telemetry.points("fastapi_requests_duration_seconds") == {}
+    (span,) = telemetry.span_exporter.get_finished_spans()
+    assert span.name == "GET /fail"
+
+
+def test_compile_routes_regex_gives_first_matching_route():
+    routes = [
+        Route("/items/{item_id:int}", endpoint),
+        Route("/items/{name}", endpoint),
+        Mount("/static", routes=[Route("/file", endpoint)]),
+    ]
+    regex = compile_routes_regex(routes)
+
+    assert regex.match("/items/1").lastgroup == "r0"
+    assert regex.match("/items/abc").lastgroup == "r1"
+    assert regex.match("/static/file").lastgroup == "r2"
+    assert regex.match("/unknown") is None
+
+
+def test_compile_routes_regex_without_path_regex():
+    assert compile_routes_regex([Host("example.com", app=endpoint)]) is None
+
+
+def test_get_path_checks_method_after_path_match():
+    app, middleware = make_app(
+        [
+            WebSocketRoute("/items/{item_id}", endpoint),
+            Route("/items/{item_id:int}", endpoint, methods=["POST"]),
+            Route("/items/{item_id}", endpoint, methods=["GET"]),
+        ]
+    )
+
+    assert get_path(middleware, app, "GET", "/items/1") == ("/items/{item_id}", True)
+    assert get_path(middleware, app, "POST", "/items/1") == (
+        "/items/{item_id:int}",
+        True,
+    )
+    assert get_path(middleware, app, "POST", "/items/a") == ("/items/a", False)
+    assert get_path(middleware, app, "GET", "/other") == ("/other", False)
+
+
+def test_get_path_strips_root_path_like_starlette():
+    app, middleware = make_app([Route("/items", endpoint)])
+
+    assert get_path(middleware, app, "GET", "/api/items", "/api") == ("/items", True)
+    assert get_path(middleware, app, "GET", "/apiX/items", "/api") == (
+        "/apiX/items",
+        False,
+    )
+
+
+def test_get_path_sees_routes_added_after_first_request():
+    app, middleware = make_app([Route("/", endpoint)])
+    assert get_path(middleware, app, "GET", "/late") == ("/late", False)
+
+    app.add_route("/late", endpoint)
+
+    assert get_path(middleware, app, "GET", "/late") == ("/late", True)
+
+
+def test_otlp_compression_defaults_to_gzip_unless_configured(monkeypatch):
+    signal = "OTEL_EXPORTER_OTLP_TRACES_COMPRESSION"
+    monkeypatch.delenv(signal, raising=False)
+    monkeypatch.delenv("OTEL_EXPORTER_OTLP_COMPRESSION", raising=False)
+    assert otlp_compression(signal, grpc.Compression) == grpc.Compression.Gzip
+
+    monkeypatch.setenv("OTEL_EXPORTER_OTLP_COMPRESSION", "deflate")
+    assert otlp_compression(signal, grpc.Compression) is None
+
+    monkeypatch.setenv(signal, "none")
+    assert otlp_compression(signal, grpc.Compression) == grpc.Compression.NoCompression
+
+
+def test_traces_sampler_defers_to_otel_traces_sampler(monkeypatch):
+    monkeypatch.delenv("OTEL_TRACES_SAMPLER", raising=False)
+    monkeypatch.setenv("OTEL_TRACES_SAMPLER_ARG", "0.25")
+    assert "0.25" in traces_sampler().get_description()
+
+    monkeypatch.setenv("OTEL_TRACES_SAMPLER_ARG", "often")
+    assert "1.0" in traces_sampler().get_description()
+
+    monkeypatch.setenv("OTEL_TRACES_SAMPLER", "always_off")
+    assert traces_sampler() is None
@@ -1,39 +1,108 @@
 import logging
-import time
-from typing import Tuple
+import os
+import re
+from itertools import islice
+from time import perf_counter_ns
+from typing import Dict, List, Optional, Pattern, Tuple
 
-from opentelemetry import context, trace
+import grpc
+from opentelemetry import trace
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.asgi import asgi_getter, asgi_setter
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.instrumentation.logging import LoggingInstrumentor
+from opentelemetry.instrumentation.logging.constants import DEFAULT_LOGGING_FORMAT
+from opentelemetry.instrumentation.logging.environment_variables import (
+    OTEL_PYTHON_LOG_FORMAT,
+    OTEL_PYTHON_LOG_LEVEL,
+)
 from opentelemetry import metrics as otel_metrics
-from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+from opentelemetry.exporter.otlp.proto.http import Compression as HTTPCompression
+from opentelemetry.exporter.otlp.proto.http.metric_exporter import (
+    OTLPMetricExporter as OTLPHTTPMetricExporter,
+)
 from opentelemetry.propagate import extract
 from opentelemetry.sdk.metrics import MeterProvider
 from opentelemetry.sdk.metrics.export import (
     PeriodicExportingMetricReader,
     ConsoleMetricExporter,
 )
+from opentelemetry.sdk.environment_variables import (
+    OTEL_BSP_EXPORT_TIMEOUT,
+    OTEL_BSP_MAX_EXPORT_BATCH_SIZE,
+    OTEL_BSP_MAX_QUEUE_SIZE,
+    OTEL_BSP_SCHEDULE_DELAY,
+    OTEL_EXPORTER_OTLP_COMPRESSION,
+    OTEL_EXPORTER_OTLP_METRICS_COMPRESSION,
+    OTEL_EXPORTER_OTLP_METRICS_PROTOCOL,
+    OTEL_EXPORTER_OTLP_PROTOCOL,
+    OTEL_EXPORTER_OTLP_TRACES_COMPRESSION,
+    OTEL_TRACES_SAMPLER,
+    OTEL_TRACES_SAMPLER_ARG,
+)
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
-from starlette.requests import Request
-from starlette.responses import Response
-from starlette.routing import Match
+from opentelemetry.sdk.trace.sampling import ParentBased, Sampler, TraceIdRatioBased
+from starlette.routing import BaseRoute, Match
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
-from starlette.types import ASGIApp
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from uvicorn.logging import AccessFormatter
+
+try:
+    # Path matched by the routes, as computed by the installed Starlette routing
+    from starlette._utils import get_route_path
+except ImportError:  # private helper, not available in every Starlette version
+
+    def get_route_path(scope: Scope) -> str:
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            return path[len(root_path) :]
+        return path
+
+
+# Maximum number of (method, path) entries kept by the route resolution cache
+ROUTES_CACHE_SIZE = 1024
 
+_NAMED_GROUP = re.compile(r"\(\?P<[^>]+>")
 
-class OtelMiddleware(BaseHTTPMiddleware):
+
+def compile_routes_regex(routes: List[BaseRoute]) -> Optional[Pattern[str]]:
+    """Merge the routes path regexes in a single alternation.
+
+    The name of the matching group (`r<index>`) gives the first route whose
+    path matches. Returns None if a route cannot be matched on its path only
+    (e.g. `Host`).
+    """
+    patterns = []
+    for index, route in enumerate(routes):
+        path_regex = getattr(route, "path_regex", None)
+        if path_regex is None:
+            return None
+        # Path parameters groups are not needed and their names may clash
+        pattern = _NAMED_GROUP.sub("(?:", path_regex.pattern)
+        patterns.append(f"(?P<r{index}>{pattern})")
+    return re.compile("|".join(patterns))
+
+
+class OtelMiddleware:
     def __init__(
-        self, app: ASGIApp, app_name: str, meter_provider, trace_provider
+        self,
+        app: ASGIApp,
+        app_name: str,
+        meter_provider,
+        trace_provider,
+        histogram_meter_provider=None,
     ) -> None:
-        super().__init__(app)
+        self.app = app
         self.app_name = app_name
         self.tracer = trace_provider.get_tracer("otel-middleware")
         meter = meter_provider.get_meter("otel-middleware", version="1.0.0")
+        # Histograms may be collected by a provider exporting less often
+        histogram_meter = (histogram_meter_provider or meter_provider).get_meter(
+            "otel-middleware", version="1.0.0"
+        )
 
         self.m_requests = meter.create_counter(
             "fastapi_requests_total",
@@ -43,7 +112,7 @@ class OtelMiddleware(BaseHTTPMiddleware):
             "fastapi_responses_total",
             description="Total count of responses by method, path and status codes.",
         )
-        self.m_requests_processing_time = meter.create_histogram(
+        self.m_requests_processing_time = histogram_meter.create_histogram(
             "fastapi_requests_duration_seconds",
             unit="s",
             description="Histogram of requests processing time by path (in seconds)",
@@ -52,66 +121,397 @@ class OtelMiddleware(BaseHTTPMiddleware):
             "fastapi_exceptions_total",
             description="Total count of exceptions raised by path and exception type",
         )
-        self.m_requests_in_progress = meter.create_up_down_counter(
-            "fastapi_requests_in_progress",
-            description="Gauge of requests by method and path currently being processed",
+        # Requests in progress are not tracked with an up-down counter as it would
+        # take the SDK lock twice per request; they are derived at query time:
+        # fastapi_requests_total - fastapi_responses_total
+
+        self._attributes_cache: Dict[Tuple[str, str], Tuple[str, Dict[str, str]]] = {}
+        self._exception_attributes_cache: Dict[Tuple[str, str, str], Dict[str, str]] = (
+            {}
         )
+        # Bounded as HTTP status codes are a small set of values
+        self._response_attributes_cache: Dict[
+            Tuple[str, str, int], Dict[str, object]
+        ] = {}
+        self._routes_cache: Dict[Tuple[str, str], Tuple[str, bool]] = {}
+        self._routes_cache_router = None
+        self._routes_cache_count = 0
+        self._routes_regex: Optional[Pattern[str]] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-    async def dispatch(
-        self, request: Request, call_next: RequestResponseEndpoint
-    ) -> Response:
-        method = request.method
-        path, is_handled_path = self.get_path(request)
+        method = scope["method"]
+        path, is_handled_path = self.get_path(scope)
         if not is_handled_path:
-            return await call_next(request)
+            await self.app(scope, receive, send)
+            return
+
+        # Instrument methods bound to locals, looked up once per request
+        add_request = self.m_requests.add
+        add_response = self.m_responses.add
+        add_exception = self.m_exceptions.add
+        record_processing_time = self.m_requests_processing_time.record
+
+        cached = self._attributes_cache.get((method, path))
+        if cached is None:
+            # Handled paths are route templates so this cache is bounded
+            cached = self._attributes_cache[(method, path)] = (
+                f"{method} {path}",
+                {"method": method, "path": path, "app_name": self.app_name},
+            )
+        span_name, attributes = cached
+
+        ctx = extract(scope, getter=asgi_getter)
 
-        attributes = {"method": method, "path": path, "app_name": self.app_name}
+        status_code = HTTP_500_INTERNAL_SERVER_ERROR
 
-        ctx = extract(request.scope, getter=asgi_getter)
-        context.attach(ctx)
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
 
         with self.tracer.start_as_current_span(
-            f"{method} {path}",
+            span_name,
             context=ctx,
             kind=trace.SpanKind.SERVER,
             attributes=attributes,
         ):
-            self.m_requests_in_progress.add(1, attributes)
+            add_request(1, attributes)
 
-            self.m_requests.add(1, attributes)
-
-            before_time = time.perf_counter()
+            before_time = perf_counter_ns()
             try:
-                response = await call_next(request)
+                await self.app(scope, receive, send_wrapper)
             except BaseException as e:
                 status_code = HTTP_500_INTERNAL_SERVER_ERROR
-                exception_attributes = attributes.copy()
-                exception_attributes.update({"exception_type": type(e).__name__})
-                self.m_exceptions.add(1, exception_attributes)
-                raise e from None
+                exception_type = type(e).__name__
+                key = (method, path, exception_type)
+                exception_attributes = self._exception_attributes_cache.get(key)
+                if exception_attributes is None:
+                    exception_attributes = self._exception_attributes_cache[key] = {
+                        **attributes,
+                        "exception_type": exception_type,
+                    }
+                add_exception(1, exception_attributes)
+                raise
             else:
-                status_code = response.status_code
-                after_time = time.perf_counter()
+                after_time = perf_counter_ns()
 
-                self.m_requests_processing_time.record(
-                    after_time - before_time, attributes
-                )
+                # Integer nanoseconds delta, converted to seconds once
+                record_processing_time((after_time - before_time) / 1e9, attributes)
             finally:
-                response_attributes = attributes.copy()
-                response_attributes.update({"status_code": status_code})
-                self.m_responses.add(1, response_attributes)
-                self.m_requests_in_progress.add(-1, attributes)
+                key = (method, path, status_code)
+                response_attributes = self._response_attributes_cache.get(key)
+                if response_attributes is None:
+                    response_attributes = self._response_attributes_cache[key] = {
+                        **attributes,
+                        "status_code": status_code,
+                    }
+                add_response(1, response_attributes)
+
+    def get_path(self, scope: Scope) -> Tuple[str, bool]:
+        router = scope["app"].router
+        routes = router.routes
+        if (
+            router is not self._routes_cache_router
+            or len(routes) != self._routes_cache_count
+        ):
+            # The application router was replaced (e.g. reload) or routes were
+            # added after startup, forget the resolved routes. A route replaced in
+            # place, keeping the number of routes, is not detected: rebuild the
+            # router instead of mutating `router.routes` items.
+            self._routes_cache.clear()
+            self._routes_regex = compile_routes_regex(routes)
+            self._routes_cache_router = router
+            self._routes_cache_count = len(routes)
+
+        key = (scope["method"], scope["path"])
+        cached = self._routes_cache.get(key)
+        if cached is not None:
+            return cached
 
-            return response
+        result = scope["path"], False
+        start = 0
+        if self._routes_regex is not None:
+            # Skip the routes whose path does not match, the method and scope
+            # type are still checked by `route.matches`
+            path_match = self._routes_regex.match(get_route_path(scope))
+            start = int(path_match.lastgroup[1:]) if path_match else len(routes)
 
-    @staticmethod
-    def get_path(request: Request) -> Tuple[str, bool]:
-        for route in request.app.routes:
-            match, child_scope = route.matches(request.scope)
+        for route in islice(routes, start, None):
+            match, child_scope = route.matches(scope)
             if match == Match.FULL:
-                return route.path, True
+                result = route.path, True
+                break
+
+        if len(self._routes_cache) >= ROUTES_CACHE_SIZE:
+            # Evict the oldest entry to bound memory with high path cardinality
+            del self._routes_cache[next(iter(self._routes_cache))]
+        self._routes_cache[key] = result
+        return result
 
-        return request.url.path, False
+
+class OtelFormatter(logging.Formatter):
+    """
+    Formatter adding the current trace context to the records it formats.
+
+    Unlike `LoggingInstrumentor` record factory, the span context is only looked up
+    when a record is formatted with a format using the OpenTelemetry fields, not for
+    every record created in the process.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._with_otel_fields = "%(otel" in (self._fmt or "")
+        resource = getattr(trace.get_tracer_provider(), "resource", None)
+        self._service_name = (
+            resource.attributes.get("service.name", "") if resource else ""
+        )
+
+    def format(self, record: logging.LogRecord) -> str:
+        if self._with_otel_fields:
+            ctx = trace.get_current_span().get_span_context()
+            if ctx.is_valid:
+                record.otelTraceID = f"{ctx.trace_id:032x}"
+                record.otelSpanID = f"{ctx.span_id:016x}"
+                record.otelTraceSampled = ctx.trace_flags.sampled
+            else:
+                record.otelTraceID = "0"
+                record.otelSpanID = "0"
+                record.otelTraceSampled = False
+            record.otelServiceName = self._service_name
+        return super().format(record)
+
+
+class OtelAccessFormatter(OtelFormatter, AccessFormatter):
+    """Uvicorn access log formatter adding the current trace context."""
+
+
+def setting_logging_format() -> None:
+    """Log on the root logger with the trace context in the format."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        OtelFormatter(os.environ.get(OTEL_PYTHON_LOG_FORMAT) or DEFAULT_LOGGING_FORMAT)
+    )
+    log_level = logging.getLevelName(
+        os.environ.get(OTEL_PYTHON_LOG_LEVEL, "info").upper()
+    )
+    logging.basicConfig(
+        handlers=[handler],
+        level=log_level if isinstance(log_level, int) else logging.INFO,
+    )
+
+
+def environ_int(name: str, default: int) -> int:
+    """Read an integer environment variable, falling back to `default` if invalid."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logging.getLogger("fastapi_app").warning(
+            "Invalid value %r for %s, using %s.", value, name, default
+        )
+        return default
+
+
+def otlp_compression(signal_environ_key: str, compression_class):
+    """
+    Compression of an OTLP exporter, given its `Compression` enum.
+
+    Exports are compressed with gzip so large batches drain faster, unless
+    compression is set through the signal specific variable or
+    `OTEL_EXPORTER_OTLP_COMPRESSION`.
+    """
+    value = os.environ.get(
+        signal_environ_key, os.environ.get(OTEL_EXPORTER_OTLP_COMPRESSION)
+    )
+    if value is None:
+        return compression_class.Gzip
+    if value.strip().lower() == "none":
+        # Not understood by the environment parsing of all exporters
+        return compression_class.NoCompression
+    # Let the exporter resolve the configured compression
+    return None
+
+
+def otlp_metrics_protocol() -> str:
+    """Return the OTLP transport for metrics, `grpc` (default) or `http/protobuf`."""
+    # Export metrics over gRPC like traces, unless HTTP is requested
+    # (e.g. Prometheus OTLP receiver only supports http/protobuf)
+    metrics_protocol = os.environ.get(
+        OTEL_EXPORTER_OTLP_METRICS_PROTOCOL,
+        os.environ.get(OTEL_EXPORTER_OTLP_PROTOCOL, "grpc"),
+    )
+    if metrics_protocol not in ("grpc", "http/protobuf"):
+        logging.getLogger("fastapi_app").warning(
+            "Unsupported OTLP metrics protocol %r, exporting metrics with grpc.",
+            metrics_protocol,
+        )
+        metrics_protocol = "grpc"
+    return metrics_protocol
+
+
+def setting_metric_reader(
+    export_interval_millis: int, metrics_protocol: str
+) -> PeriodicExportingMetricReader:
+    """Create a periodic reader with its own OTLP metric exporter."""
+    if metrics_protocol == "http/protobuf":
+        metric_exporter = OTLPHTTPMetricExporter(
+            compression=otlp_compression(
+                OTEL_EXPORTER_OTLP_METRICS_COMPRESSION, HTTPCompression
+            )
+        )
+    else:
+        metric_exporter = OTLPMetricExporter(
+            compression=otlp_compression(
+                OTEL_EXPORTER_OTLP_METRICS_COMPRESSION, grpc.Compression
+            )
+        )
+
+    # Debug exporter to print metric on stdout
+    # PeriodicExportingMetricReader(ConsoleMetricExporter(), export_interval_millis=5_000)
+    return PeriodicExportingMetricReader(
+        metric_exporter,
+        export_interval_millis=export_interval_millis,
+        export_timeout_millis=5_000,
+    )
+
+
+def traces_sampler() -> Optional[Sampler]:
+    """
+    Sample root spans at source, child spans follow their parent decision.
+
+    The sampler configured with `OTEL_TRACES_SAMPLER` is used instead if any.
+    Paths like health checks could be dropped with a custom sampler
+    delegating to `TraceIdRatioBased` for the other spans.
+    """
+    if OTEL_TRACES_SAMPLER in os.environ:
+        # Let the tracer provider resolve the configured sampler
+        return None
+    ratio = 1.0
+    value = os.environ.get(OTEL_TRACES_SAMPLER_ARG)
+    if value is not None:
+        try:
+            ratio = float(value)
+            if not 0.0 <= ratio <= 1.0:
+                raise ValueError(value)
+        except ValueError:
+            logging.getLogger("fastapi_app").warning(
+                "Invalid value %r for %s, using 1.0.", value, OTEL_TRACES_SAMPLER_ARG
+            )
+            ratio = 1.0
+    return ParentBased(root=TraceIdRatioBased(ratio))
+
+
+# Providers installed by `setting_providers`, shared by all applications of the process
+_tracer_provider: Optional[TracerProvider] = None
+_meter_provider: Optional[MeterProvider] = None
+_histogram_meter_provider: Optional[MeterProvider] = None
+_providers_app_name: Optional[str] = None
+_providers_resource: Optional[Resource] = None
+_metrics_protocol: Optional[str] = None
+
+
+def setting_histogram_meter_provider() -> MeterProvider:
+    """
+    Create the meter provider dedicated to histograms only once.
+
+    Counters are cheap to collect and exported often; histograms are exported
+    less often by their own provider so their collection does not delay counters.
+    Both providers push a `target_info` series to Prometheus, the extra resource
+    attribute keeps them apart instead of interleaving the samples of one series
+    from two exporters.
+    """
+    global _histogram_meter_provider
+    if _histogram_meter_provider is None:
+        _histogram_meter_provider = MeterProvider(
+            resource=_providers_resource.merge(
+                Resource({"meter_provider": "histograms"})
+            ),
+            metric_readers=[setting_metric_reader(10_000, _metrics_protocol)],
+        )
+    return _histogram_meter_provider
+
+
+def setting_providers(
+    app_name: str,
+    histograms: bool = False,
+) -> Tuple[TracerProvider, MeterProvider, Optional[MeterProvider]]:
+    """
+    Create and install the global tracer and meter providers only once.
+
+    Each provider owns an exporter thread, so later calls return the providers
+    already installed instead of leaking new ones that would export everything twice.
+    The third provider, dedicated to histograms, is only created with `histograms`.
+    """
+    global _tracer_provider, _meter_provider, _providers_app_name
+    global _providers_resource, _metrics_protocol
+    if _tracer_provider is not None and _meter_provider is not None:
+        if app_name != _providers_app_name:
+            logging.getLogger("fastapi_app").warning(
+                "OpenTelemetry providers already installed for service %s, "
+                "telemetry of service %s will be reported as %s.",
+                _providers_app_name,
+                app_name,
+                _providers_app_name,
+            )
+        return (
+            _tracer_provider,
+            _meter_provider,
+            setting_histogram_meter_provider() if histograms else None,
+        )
+
+    # Setting OpenTelemetry
+    # set the service name to show in traces
+    resource = Resource.create(
+        attributes={
+            # Standard attribute to reference a service
+            "service.name": app_name,
+            # Attributes to link traces to logs
+            "compose_service": app_name,
+        }
+    )
+
+    # set the tracer provider
+    tracer = TracerProvider(resource=resource, sampler=traces_sampler())
+    # Larger queue and shorter delay than the SDK defaults to avoid dropping
+    # spans on bursts; the standard OTEL_BSP_* variables still take precedence
+    tracer.add_span_processor(
+        BatchSpanProcessor(
+            OTLPSpanExporter(
+                compression=otlp_compression(
+                    OTEL_EXPORTER_OTLP_TRACES_COMPRESSION, grpc.Compression
+                )
+            ),
+            max_queue_size=environ_int(OTEL_BSP_MAX_QUEUE_SIZE, 4096),
+            schedule_delay_millis=environ_int(OTEL_BSP_SCHEDULE_DELAY, 1_000),
+            max_export_batch_size=environ_int(OTEL_BSP_MAX_EXPORT_BATCH_SIZE, 256),
+            export_timeout_millis=environ_int(OTEL_BSP_EXPORT_TIMEOUT, 10_000),
+        )
+    )
+    trace.set_tracer_provider(tracer)
+
+    metrics_protocol = otlp_metrics_protocol()
+    meter_provider = MeterProvider(
+        resource=resource,
+        metric_readers=[setting_metric_reader(5_000, metrics_protocol)],
+    )
+    otel_metrics.set_meter_provider(meter_provider)
+
+    _tracer_provider, _meter_provider = tracer, meter_provider
+    _providers_app_name = app_name
+    _providers_resource = resource
+    _metrics_protocol = metrics_protocol
+    return (
+        tracer,
+        meter_provider,
+        setting_histogram_meter_provider() if histograms else None,
+    )
 
 
 def setting_otlp(
@@ -132,37 +532,13 @@ def setting_otlp(
         auto_instrumentation_level,
     )
     if auto_instrumentation_level < "2":
-        # Setting OpenTelemetry
-        # set the service name to show in traces
-        resource = Resource.create(
-            attributes={
-                # Standard attribute to reference a service
-                "service.name": app_name,
-                # Attributes to link traces to logs
-                "compose_service": app_name,
-            }
-        )
-
-        # set the tracer provider
-        tracer = TracerProvider(resource=resource)
-        tracer.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
-        trace.set_tracer_provider(tracer)
-
-        reader = PeriodicExportingMetricReader(
-            OTLPMetricExporter(),
-            export_interval_millis=5_000,
-        )
-        # Debug exporter to print metric on stdout
-        # reader2 = PeriodicExportingMetricReader(ConsoleMetricExporter(), export_interval_millis=5_000)
-        meter_provider = MeterProvider(
-            resource=resource,
-            metric_readers=[reader],
+        tracer, meter_provider, histogram_meter_provider = setting_providers(
+            app_name, histograms=auto_instrumentation_level == "0"
         )
-        otel_metrics.set_meter_provider(meter_provider)
 
         if log_correlation:
-            logging.getLogger("fastapi_app").info("Set logging instrumentation")
-            LoggingInstrumentor().instrument(set_logging_format=True)
+            setting_logging_format()
+            logging.getLogger("fastapi_app").info("Set logging trace correlation")
 
         if auto_instrumentation_level == "0":
             logging.getLogger("fastapi_app").info("Use custom otel meters.")
@@ -171,6 +547,7 @@ def setting_otlp(
                 app_name=app_name,
                 meter_provider=meter_provider,
                 trace_provider=tracer,
+                histogram_meter_provider=histogram_meter_provider,
             )
         elif auto_instrumentation_level == "1":
             logging.getLogger("fastapi_app").info("Set FastAPI instrumentor.")